@@ -3,6 +3,7 @@ from .routines import (
     checkpoint,  # Save codebase to a zip file
     checkpoint_to_wandb,  # Save codebase to a zip file and upload to wandb
     WandBCodebase,  # Load codebase directly from wandb
+    wait_for_uploads,  # Block until checkpoint_to_wandb uploads are done
 )
 
 # These allow you to load a codebase from a zip file
@@ -11,10 +11,12 @@ from .routines import (
 )
 
 from .base import change_launcher # make a zip file runnable
+from .base import _rewrite_without
 
 import logging
+import os
 from pathlib import Path
-import shutil
+import zipfile
 
 def codesave_app(args=None):
     parser = argparse.ArgumentParser()
@@ -44,6 +46,20 @@ def codesave_app(args=None):
     parser.add_argument(
         "--ignore_larger_than", type=str, help="Only save files smaller than this size."
     )
+    parser.add_argument(
+        "--compresslevel", type=int, default=1, help="Compression level, from 1 (fastest) to 9 (smallest)."
+    )
+    parser.add_argument(
+        "--no_compression", action="store_true", help="Store files without compressing them"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Compress files in parallel using this many threads."
+    )
+    parser.add_argument(
+        "--strong",
+        action="store_true",
+        help="Compress as much as possible (same as --compresslevel 9), e.g. if the zip will be uploaded",
+    )
 
     args = parser.parse_args(args)
     checkpoint(
@@ -53,6 +69,9 @@ def codesave_app(args=None):
         extra_pythonpath=args.extra_pythonpath,
         py_only=args.py_only,
         ignore_larger_than=args.ignore_larger_than,
+        compression=zipfile.ZIP_STORED if args.no_compression else zipfile.ZIP_DEFLATED,
+        compresslevel=9 if args.strong else args.compresslevel,
+        num_workers=args.num_workers,
     )
 
 def wandb_app(args=None):
@@ -81,7 +100,14 @@ def make_pyz_app(args=None):
         "--output", "-o",
         type=str,
         default=None,
-        help="If None, will save to {codebase.stem}.pyz",
+        help="If None, will save to {codebase.stem}.pyz. If this is the codebase zip itself, it is modified in place.",
+    )
+    parser.add_argument(
+        "--hardlink",
+        action="store_true",
+        help="Hard link the output to the codebase zip instead of copying it. "
+        "Saves a full copy, but the launcher is appended in place, so the codebase zip gets it too "
+        "(next to its old __main__.py, which `unzip` will ask about).",
     )
 
     # Only relevant if you pass in a directory into the codebase
@@ -103,11 +129,21 @@ def make_pyz_app(args=None):
     parser.add_argument(
         "--ignore_larger_than", type=str, help="Only save files smaller than this size."
     )
+    parser.add_argument(
+        "--compresslevel", type=int, default=1, help="Compression level, from 1 (fastest) to 9 (smallest)."
+    )
+    parser.add_argument(
+        "--no_compression", action="store_true", help="Store files without compressing them"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Compress files in parallel using this many threads."
+    )
 
     args = parser.parse_args(args)
 
     logging.basicConfig(level=logging.INFO)
-    if Path(args.codebase).is_dir():
+    created_codebase = Path(args.codebase).is_dir()
+    if created_codebase:
         logging.info("First creating a codebase")
         if args.output is not None:
             output_zipname = args.output
@@ -120,6 +156,9 @@ def make_pyz_app(args=None):
             extra_pythonpath=args.extra_pythonpath,
             py_only=args.py_only,
             ignore_larger_than=args.ignore_larger_than,
+            compression=zipfile.ZIP_STORED if args.no_compression else zipfile.ZIP_DEFLATED,
+            compresslevel=args.compresslevel,
+            num_workers=args.num_workers,
         )
         args.codebase = output_zipname
 
@@ -127,9 +166,28 @@ def make_pyz_app(args=None):
     zip_name = Path(args.codebase)
     if args.output is None:
         args.output = zip_name.parent / (zip_name.stem + ".pyz")
-    if Path(args.output) != Path(args.codebase):
+    # change_launcher appends the new __main__.py after the old one. Wherever the zip is copied
+    # anyway, the copy is made without the old one, so that the output has a single __main__.py.
+    if os.path.realpath(args.output) == os.path.realpath(args.codebase):
+        logging.info("Modifying {} in place".format(args.output))
+        if created_codebase:  # only just written, so rewriting it doesn't touch any of the user's files
+            _rewrite_without(args.output, "__main__.py")
+        else:
+            logging.info("The old __main__.py is left in the zip too, so `unzip` will ask which one to keep")
+    elif args.hardlink:
+        logging.info("Linking {} to {}".format(args.output, args.codebase))
+        if os.path.lexists(args.output):
+            os.remove(args.output)
+        try:
+            os.link(args.codebase, args.output)
+        except OSError:  # e.g. across file systems
+            logging.info("Could not link, copying instead")
+            _rewrite_without(args.codebase, "__main__.py", args.output)
+        else:
+            logging.info("The old __main__.py is left in the zip too, so `unzip` will ask which one to keep")
+    else:
         logging.info("Saving to {}".format(args.output))
-        shutil.copyfile(args.codebase, args.output)
+        _rewrite_without(args.codebase, "__main__.py", args.output)
 
     external_path, internal_path, module_name = None, None, None
     if Path(args.launcher).is_file():
@@ -1,15 +1,43 @@
-import inspect
+import collections
+import contextlib
+import copy
+import os
 import tempfile
 import sys
 import shutil
+import time
+import warnings
 import datetime
+import functools
+import hashlib
 import importlib
+import importlib.metadata
 from pathlib import Path
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, List, Callable
 import json
 import fnmatch
-import pkg_resources
+import re
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads  # accepts bytes, so no need to decode first
+
+try:
+    # ISA-L's SIMD deflate is several times faster than zlib, but only has levels 0 to 3
+    from isal import isal_zlib as _deflate_zlib
+
+    _MAX_DEFLATE_LEVEL = _deflate_zlib.ISAL_BEST_COMPRESSION
+except ImportError:
+    _deflate_zlib = zlib
+    _MAX_DEFLATE_LEVEL = zlib.Z_BEST_COMPRESSION
 
 DEFAULT_MAIN = """
 import sys
@@ -33,12 +61,89 @@ else:
     runpy.run_module(module_name)
 """
 
+# Zip entries are made of many small header/data writes; buffer them so they
+# reach the disk in large chunks.
+ZIP_BUFFER_SIZE = 4 * 1024 * 1024
+# Chunk size when streaming an entry from one zip to another
+COPY_BUFFER_SIZE = 1024 * 1024
+# How many compressed or rewritten files may be held in memory before writing them out
+MAX_PENDING_REWRITES = 64
+# How many bytes of files may be read in for parallel compression before writing them out.
+# Larger files are streamed into the zip instead, like without num_workers.
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+# Files with these suffixes are already compressed, so they are stored as-is
+STORED_SUFFIXES = (".png", ".jpg", ".pt", ".pth", ".npz", ".pkl", ".zip", ".gz", ".so")
+
+
+def _compress_type(filename, compression):
+    """The compression method for `filename`: `compression`, unless the file is already compressed."""
+    if filename.lower().endswith(STORED_SUFFIXES):
+        return zipfile.ZIP_STORED
+    return compression
+
+
+@contextlib.contextmanager
+def _open_zip_for_writing(output_zipname, **zip_kwargs):
+    """Opens `output_zipname` as a new ZipFile backed by a large write buffer."""
+    with open(output_zipname, "wb", buffering=ZIP_BUFFER_SIZE) as f:
+        with zipfile.ZipFile(f, "w", **zip_kwargs) as zip:
+            yield zip
+
+
+def _deflate_file(path, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Reads and deflates a file, with isal if it is installed. Returns (crc, file_size, compressed_bytes).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if compresslevel == zlib.Z_DEFAULT_COMPRESSION:
+        compresslevel = _deflate_zlib.Z_DEFAULT_COMPRESSION
+    else:
+        compresslevel = min(compresslevel, _MAX_DEFLATE_LEVEL)
+    compressor = _deflate_zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return _deflate_zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def _write_deflated(zip, zinfo, crc, file_size, compressed):
+    """Appends an entry whose data was already deflated by `_deflate_file`.
+
+    ZipFile has no public API for this, so this mirrors what `ZipFile.open(zinfo, "w")` does,
+    minus the compression.
+    """
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.flag_bits = 0
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed)
+    if zip._writing:
+        raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+    zip64 = max(file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+    if zip64 and not zip._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    with zip._lock:
+        if zip._seekable:
+            zip.fp.seek(zip.start_dir)
+        zinfo.header_offset = zip.fp.tell()
+        zip._writecheck(zinfo)
+        zip._didModify = True
+        zip.fp.write(zinfo.FileHeader(zip64))
+        zip.fp.write(compressed)
+        zip.filelist.append(zinfo)
+        zip.NameToInfo[zinfo.filename] = zinfo
+        zip.start_dir = zip.fp.tell()
+
+
 def create_zip(
     files_and_folders: Union[List[Path], Path, str],
     output_zipname: str,
     library_names=None,
     ignore: Callable = None,
     verbose: bool = True,
+    num_workers: int = 1,
+    compression: int = zipfile.ZIP_DEFLATED,
+    compresslevel: int = 1,
+    max_file_size: int = None,
+    name_filter: Callable = None,
 ):
     """Creates a zipfile of your codebase, for reference and to investigate!
 
@@ -57,7 +162,20 @@ def create_zip(
         output_zipname: The name of the zip file to create
         library_names: A list of libraries that can be imported.
             If None, will be inferred from the files_and_folders
-        ignore: A filtering function that will be passed to `shutil.copytree` to ignore files.
+        ignore: A filtering function with the same signature as the `ignore` argument of `shutil.copytree`.
+            `__pycache__` folders are always skipped.
+        num_workers: If larger than 1, files are compressed in parallel using this many threads,
+            with the faster ISA-L deflate if `isal` is installed (which caps compresslevel at 3).
+        compression: The zipfile compression method, e.g. `zipfile.ZIP_DEFLATED` or `zipfile.ZIP_STORED`.
+            Only these two can be imported from directly.
+        compresslevel: The compression level. Level 1 is much faster than zlib's default
+            and compresses source code nearly as well.
+            Files that are already compressed (see STORED_SUFFIXES) are always stored uncompressed.
+        max_file_size: Files larger than this many bytes are skipped. Like `shutil_filters.ignore_larger_than`,
+            but checked while walking the folders, with the stat results that are needed anyway.
+        name_filter: If given, only files whose name passes `name_filter(name)` are saved
+            (e.g. `lambda name: name.endswith(".py")`). Folders are still searched.
+            Other files are dropped before `ignore` or `max_file_size` look at them.
     """
 
     verbose_print = print if verbose else lambda *a, **k: None
@@ -65,49 +183,213 @@ def create_zip(
     files_and_folders = (
         [files_and_folders] if isinstance(files_and_folders, str) else files_and_folders
     )
-    files_and_folders = [
-        Path(og_dir).expanduser().resolve() for og_dir in files_and_folders
-    ]
-
-    with tempfile.TemporaryDirectory() as main_dir:
-        main_dir = Path(main_dir)
-
-        for og_dir in files_and_folders:
-            target_dir = main_dir / og_dir.name
-            verbose_print("Copying code from {} to {}".format(og_dir, target_dir))
-            if ignore is not None:
-                if ignore(str(og_dir.parent), [og_dir.name]):
-                    verbose_print("Ignoring ", og_dir)
-                    continue
-
-            if og_dir.is_file():
-                shutil.copy(og_dir, target_dir)
-            else:
-                shutil.copytree(og_dir, target_dir, dirs_exist_ok=True, ignore=ignore)
-
-        verbose_print("Creating zip file at {}".format(output_zipname))
-        if library_names is None:
-            all_pyfiles = map(str, main_dir.glob("**/*.py"))
-            library_names = _get_library_names(all_pyfiles, index=0)
-        with open(main_dir / "library_names.json", "w") as f:
-            json.dump(library_names, f)
-        with open(main_dir / "packages.txt", "w") as f:
-            for lib in pkg_resources.working_set:
-                f.write(repr(lib) + "\n")
-        if not (main_dir / "__main__.py").exists():
-            with open(main_dir / "__main__.py", "w") as f:
-                f.write(DEFAULT_MAIN)
-            
-        shutil.make_archive(
-            str(output_zipname),
-            "zip",
-            root_dir=main_dir,
-            verbose=verbose,
-        )
-        shutil.move(str(output_zipname) + ".zip", output_zipname)        
+    # Resolved, so that the same file or folder given twice (e.g. both as a library and as part of
+    # the main folder) is only walked and written once
+    files_and_folders = list(
+        dict.fromkeys(Path(og_dir).expanduser().resolve() for og_dir in files_and_folders)
+    )
+
+    # Maps the name inside the zip to the file (or folder) on disk. Later entries
+    # take precedence, like copying everything into a single directory would.
+    files_to_add = {}
+    # A parent folder shared by several inputs is scanned once. The DirEntries from that scan cache
+    # is_file() and stat(), so each of those inputs is classified, size-checked and written with a
+    # single stat. Other inputs are just stat'ed, rather than scanning a possibly large parent.
+    parent_counts = collections.Counter(str(og_dir.parent) for og_dir in files_and_folders)
+    parent_entries = {}
+    for og_dir in files_and_folders:
+        if og_dir.name == "__pycache__":
+            verbose_print("Ignoring ", og_dir)
+            continue
+        verbose_print("Adding code from {}".format(og_dir))
+        parent = str(og_dir.parent)
+        if parent_counts[parent] > 1 and parent not in parent_entries:
+            try:
+                parent_entries[parent] = _dir_entries(parent)
+            except OSError:  # e.g. a parent that can be entered but not listed
+                parent_entries[parent] = None
+        entries = parent_entries.get(parent)
+        if entries is None:
+            # A Path has the is_file() and stat() that the filters use from a DirEntry
+            entries = {og_dir.name: og_dir}
+        source = entries.get(og_dir.name, og_dir)
+        if ignore is not None:
+            if _call_ignore(ignore, parent, [og_dir.name], entries):
+                verbose_print("Ignoring ", og_dir)
+                continue
+
+        if source.is_file():
+            if name_filter is not None and not name_filter(og_dir.name):
+                verbose_print("Ignoring ", og_dir)
+                continue
+            if max_file_size is not None and source.stat().st_size > max_file_size:
+                verbose_print("Ignoring ", og_dir)
+                continue
+            files_to_add[og_dir.name] = source
+            continue
+
+        files_to_add[og_dir.name + "/"] = source
+        for entry, arcname in _iter_files(
+            str(og_dir), og_dir.name, ignore, max_file_size, name_filter
+        ):
+            files_to_add[arcname] = entry
+
+    # A fixed order, independent of the file system, keeps similar files next to each other
+    # and makes the same codebase produce the same sequence of entries every time.
+    files_to_add = dict(
+        sorted(files_to_add.items(), key=lambda item: (os.path.splitext(item[0])[1], item[0]))
+    )
+
+    verbose_print("Creating zip file at {}".format(output_zipname))
+    if library_names is None:
+        library_names = _get_library_names(files_to_add, index=0)
+    with _open_zip_for_writing(
+        output_zipname, compression=compression, compresslevel=compresslevel
+    ) as zip:
+        if num_workers > 1 and compression == zipfile.ZIP_DEFLATED:
+            _write_files_in_parallel(zip, files_to_add, num_workers, compresslevel)
+        else:
+            for arcname, source in files_to_add.items():
+                _write_file(zip, source, arcname, _compress_type(arcname, compression))
+        zip.writestr("library_names.json", _json_dumps(library_names))
+        zip.writestr("packages.txt", _installed_packages())
+        if "__main__.py" not in files_to_add:
+            zip.writestr("__main__.py", DEFAULT_MAIN)
     print("Saved codebase to ", output_zipname)
 
 
+def _installed_packages():
+    """The installed distributions, one `name==version` per line, for packages.txt."""
+    packages = {}
+    for dist in importlib.metadata.distributions():
+        name = dist.metadata["Name"]
+        # Like the import system, the first distribution found on sys.path wins
+        if name is not None and name not in packages:
+            packages[name] = dist.version
+    return "".join("{}=={}\n".format(name, version) for name, version in packages.items())
+
+
+def _iter_files(folder, arcname, ignore=None, max_file_size=None, name_filter=None):
+    """
+    Yields (os.DirEntry, arcname) for everything inside `folder`, skipping `__pycache__`
+    folders, files larger than `max_file_size` or rejected by `name_filter`, and whatever
+    `ignore` excludes. Folders get an arcname ending with a slash, like in a zip.
+    """
+    # An explicit stack rather than recursion, so deep trees don't pass every entry up
+    # through a chain of nested generators
+    folders = [(folder, arcname)]
+    while folders:
+        folder, arcname = folders.pop()
+        with os.scandir(folder) as it:
+            entries = [entry for entry in it if entry.name != "__pycache__"]
+        if name_filter is not None:
+            # is_dir() is usually known from the scan itself; only symlinks, which it follows, cost a stat
+            entries = [entry for entry in entries if entry.is_dir() or name_filter(entry.name)]
+        if ignore is not None:
+            ignored = _call_ignore(
+                ignore,
+                folder,
+                [entry.name for entry in entries],
+                {entry.name: entry for entry in entries},
+            )
+            if not isinstance(ignored, (set, frozenset)):  # e.g. from shutil.ignore_patterns
+                ignored = set(ignored)
+            entries = [entry for entry in entries if entry.name not in ignored]
+        for entry in entries:
+            # Like shutil.copytree, symlinked folders are followed
+            if entry.is_dir():
+                yield entry, arcname + "/" + entry.name + "/"
+                folders.append((entry.path, arcname + "/" + entry.name))
+            elif (
+                max_file_size is None
+                or not entry.is_file()
+                or entry.stat().st_size <= max_file_size  # cached, and reused to write the file
+            ):
+                yield entry, arcname + "/" + entry.name
+
+
+def _zipinfo_from_stat(st, arcname):
+    """Like ZipInfo.from_file, but for a stat result we already have (e.g. cached by an os.DirEntry)."""
+    date_time = time.localtime(st.st_mtime)[:6]
+    # Zip timestamps can only store 1980 to 2107, so clamp like ZipFile(strict_timestamps=False)
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    elif date_time[0] > 2107:
+        date_time = (2107, 12, 31, 23, 59, 59)
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    if arcname.endswith("/"):
+        zinfo.file_size = 0
+        zinfo.external_attr |= 0x10  # MS-DOS directory flag
+    else:
+        zinfo.file_size = st.st_size
+    return zinfo
+
+
+def _write_file(zip, source, arcname, compress_type):
+    """Like ZipFile.write, but `source` (an os.DirEntry or a Path) provides the stat result."""
+    zinfo = _zipinfo_from_stat(source.stat(), arcname)
+    if zinfo.is_dir():
+        zip.writestr(zinfo, b"")
+        return
+    zinfo.compress_type = compress_type
+    zinfo._compresslevel = zip.compresslevel
+    with open(source, "rb") as src, zip.open(zinfo, "w") as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def _write_files_in_parallel(zip, files_to_add, num_workers, compresslevel=None):
+    """
+    Writes `files_to_add` to `zip`, deflating the files in a pool of worker threads
+    (zlib releases the GIL while compressing). Only this thread writes to `zip`.
+    Already compressed files (see STORED_SUFFIXES) are stored directly instead,
+    and files larger than MAX_PENDING_BYTES are streamed in by this thread.
+    """
+    if compresslevel is None:
+        compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    pending = collections.deque()
+    pending_bytes = 0
+
+    def write_oldest():
+        nonlocal pending_bytes
+        arcname, st, future = pending.popleft()
+        crc, file_size, compressed = future.result()
+        pending_bytes -= st.st_size
+        _write_deflated(zip, _zipinfo_from_stat(st, arcname), crc, file_size, compressed)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        for arcname, source in files_to_add.items():
+            compress_type = _compress_type(arcname, zipfile.ZIP_DEFLATED)
+            if arcname.endswith("/") or compress_type == zipfile.ZIP_STORED:
+                _write_file(zip, source, arcname, compress_type)
+                continue
+            st = source.stat()
+            if st.st_size > MAX_PENDING_BYTES:
+                _write_file(zip, source, arcname, compress_type)
+                continue
+            # Bounds how many files, and how many bytes of them, are held in memory at once
+            while pending and (
+                len(pending) >= MAX_PENDING_REWRITES
+                or pending_bytes + st.st_size > MAX_PENDING_BYTES
+            ):
+                write_oldest()
+            pending.append((arcname, st, executor.submit(_deflate_file, source, compresslevel)))
+            pending_bytes += st.st_size
+        while pending:
+            write_oldest()
+
+
+def _renamed_zipinfo(info, filename, compression, compresslevel):
+    """A ZipInfo for writing `info`'s file as `filename`, compressed with the given settings."""
+    new_info = zipfile.ZipInfo(filename, date_time=info.date_time)
+    new_info.external_attr = info.external_attr
+    new_info.compress_type = _compress_type(filename, compression)
+    new_info._compresslevel = compresslevel
+    # Lets ZipFile.open(new_info, "w") decide upfront whether ZIP64 is needed
+    new_info.file_size = info.file_size
+    return new_info
+
+
 def create_unique_zip(
     input_zipname: str,
     output_zipname: str,
@@ -116,6 +398,8 @@ def create_unique_zip(
     verbose: bool = True,
     save_non_code: bool = True,
     add_init: bool = True,
+    compression: int = zipfile.ZIP_DEFLATED,
+    compresslevel: int = 1,
 ):
     """
     Turns a zip from `create_zip` into a zip that can be *jointly loaded* with other codebases using ZipCodebase.
@@ -129,77 +413,102 @@ def create_unique_zip(
         output_zipname: The path to save the zip file to
         prefix: A prefix that will be added to all imports. If None, defaults to `codebase_<timestamp>`
             This is what allows us to load multiple versions of the same codebase.
+        compression, compresslevel: How entries are compressed in the new zip, see `create_zip`.
 
+    Returns:
+        The libraries in the codebase (which are now importable as `prefix.library`).
     """
     verbose_print = print if verbose else lambda *a, **k: None
     prefix = prefix or "codebase_{:}".format(
         datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     )
     with zipfile.ZipFile(input_zipname, "r") as zip:
-        with zipfile.ZipFile(output_zipname, "w") as new_zip:
-            namelist = zip.namelist()
+        with _open_zip_for_writing(
+            output_zipname, compression=compression, compresslevel=compresslevel
+        ) as new_zip:
+            infos = zip.infolist()
+            namelist = [info.filename for info in infos]
             if library_names is None:
                 if "library_names.json" in namelist:
-                    library_names = json.loads(
-                        zip.read("library_names.json").decode("utf-8")
-                    )
+                    library_names = _json_loads(zip.read("library_names.json"))
                 else:
                     library_names = _get_library_names(namelist)
             verbose_print("Found libraries: ", library_names)
             verbose_print('Adding prefix "{}"'.format(prefix))
-            for info in zip.infolist():
-                old_filename = info.filename
-                info.filename = prefix + "/" + info.filename
+            # Rewritten, so that UniqueCodebase can read the libraries that were actually prefixed
+            infos = [info for info in infos if info.filename != "library_names.json"]
+            new_zip.writestr(prefix + "/library_names.json", _json_dumps(library_names))
+            import_pattern = _import_pattern(library_names)
+            import_replacements = _import_replacements(
+                library_names, new_pattern=lambda library: f"{prefix}.{library}"
+            )
 
-                if not info.filename.endswith(".py") and save_non_code:
-                    new_zip.writestr(info, zip.read(old_filename))
-                else:
-                    s = zip.read(old_filename).decode("utf-8")
-                    s = _fix_all_imports(
-                        s,
-                        library_names,
-                        new_pattern=lambda library: f"{prefix}.{library}",
-                        old_pattern=lambda library: f"{library}",
+            def rewrite(info):
+                return _fix_all_imports(zip.read(info), import_pattern, import_replacements)
+
+            # Folders that need an __init__.py (if add_init), and those that already have one
+            package_dirs, dirs_with_init = set(), set()
+            # Files are read and rewritten by a pool of threads (zlib releases the GIL), but only
+            # this thread writes to new_zip. At most MAX_PENDING_REWRITES files are held in memory.
+            pending = collections.deque()
+            with ThreadPoolExecutor() as executor:
+                for info in infos:
+                    new_info = _renamed_zipinfo(
+                        info, prefix + "/" + info.filename, compression, compresslevel
                     )
-                    new_zip.writestr(info, s)
-
-            if add_init:
-                newzip_files = new_zip.namelist()
-                necessary_inits = set()
-                for file in newzip_files:
-                    if file.endswith(
-                        ".py"
-                    ):  # add __init__.py to all folders leading up to this file
-                        all_parts = file.split("/")
+                    if info.is_dir():
+                        new_zip.writestr(new_info, b"")
+                    elif not new_info.filename.endswith(".py") and save_non_code:
+                        # Streamed, since these can be large (e.g. data or checkpoints)
+                        with zip.open(info) as src, new_zip.open(new_info, "w") as dst:
+                            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+                    else:
+                        pending.append((new_info, executor.submit(rewrite, info)))
+                        if len(pending) >= MAX_PENDING_REWRITES:
+                            done_info, future = pending.popleft()
+                            new_zip.writestr(done_info, future.result())
+
+                    if add_init and new_info.filename.endswith(".py"):
+                        all_parts = new_info.filename.split("/")
+                        if all_parts[-1] == "__init__.py":
+                            dirs_with_init.add("/".join(all_parts[:-1]))
+                        # add __init__.py to all folders leading up to this file
                         for i in range(1, len(all_parts) - 1):
-                            necessary_inits.add(
-                                "/".join(all_parts[:i] + ["__init__.py"])
-                            )
-                for init in necessary_inits:
-                    if init not in newzip_files:
-                        new_zip.writestr(init, "")
-                        verbose_print("Adding  ", init)
+                            package_dirs.add("/".join(all_parts[:i]))
+
+                for done_info, future in pending:
+                    new_zip.writestr(done_info, future.result())
+
+            # The missing __init__.py files are all empty, so only their names differ
+            empty_info = zipfile.ZipInfo(date_time=time.localtime()[:6])
+            empty_info.external_attr = 0o600 << 16  # what writestr uses by default
+            # Stored rather than deflated like the zip's other entries: there is nothing to compress
+            empty_info.compress_type = zipfile.ZIP_STORED
+            for package_dir in sorted(package_dirs - dirs_with_init):
+                init_info = copy.copy(empty_info)
+                init_info.filename = package_dir + "/__init__.py"
+                new_zip.writestr(init_info, b"")
+                verbose_print("Adding  ", init_info.filename)
 
     print("Saved unique codebase to ", output_zipname)
+    return list(library_names)
 
 def change_launcher(zip_file: str, external_path: str = None,  internal_path: str = None, module_name: str = None):
     """Makes the zip file runnable by adding a launcher.py file to it."""
     assert sum([x is not  None for x in [external_path, module_name, internal_path]]) == 1, "Exactly one of external_path, module_name, internal_path must be provided."
 
-    tmp_name = None
-    with zipfile.ZipFile(zip_file, "r") as input_zip:    
-        if '__main__.py' in input_zip.namelist():
-            tmp_name = tempfile.mktemp(suffix=".zip")
-            with zipfile.ZipFile(tmp_name, "w") as output_zip:
-                for info in input_zip.infolist():
-                    if info.filename != '__main__.py':
-                        output_zip.writestr(info, input_zip.read(info.filename))
-
-    if tmp_name is not None:
-        shutil.move(tmp_name, zip_file)
-
-
-    with zipfile.ZipFile(zip_file, "a") as zf:
+    # Rather than rewriting the whole zip without the old __main__.py, the new one is appended
+    # after it: zipimport (and ZipFile) use the last entry with a given name. The old entry is
+    # left behind though, and `unzip` asks which of the two to keep (without a terminal, it keeps
+    # the old one), so callers that copy the zip anyway should copy it with `_rewrite_without` first.
+    # Once old launchers have piled up from earlier calls, the zip is rewritten without them.
+    with zipfile.ZipFile(zip_file, "r") as zf:
+        num_launchers = zf.namelist().count("__main__.py")
+    if num_launchers > 1:
+        _rewrite_without(zip_file, "__main__.py")
+
+    with zipfile.ZipFile(zip_file, "a") as zf, warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Duplicate name", category=UserWarning)
         if external_path is not None:
             launcher_path = Path(external_path).resolve()
             zf.write(launcher_path, arcname="__main__.py")
@@ -211,6 +520,72 @@ def change_launcher(zip_file: str, external_path: str = None,  internal_path: st
             zf.writestr("__main__.py", launcher)
 
 
+def _rewrite_without(zip_file, filename, output_zipname=None):
+    """
+    Copies `zip_file` to `output_zipname` (by default, `zip_file` itself) without any entry
+    named `filename`, keeping the last of other duplicates.
+    """
+    if output_zipname is None:
+        output_zipname = zip_file
+    with zipfile.ZipFile(zip_file, "r") as input_zip:
+        infos = {info.filename: info for info in input_zip.infolist()}
+        infos.pop(filename, None)
+        tmp_name = tempfile.mktemp(
+            suffix=".zip", dir=os.path.dirname(os.path.abspath(output_zipname))
+        )
+        try:
+            with _open_zip_for_writing(tmp_name) as output_zip:
+                for name, info in infos.items():
+                    new_info = _renamed_zipinfo(info, name, info.compress_type, None)
+                    if info.is_dir():
+                        output_zip.writestr(new_info, b"")
+                        continue
+                    with input_zip.open(info) as src, output_zip.open(new_info, "w") as dst:
+                        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+    os.replace(tmp_name, output_zipname)
+
+
+def _zip_cache_key(zip_name):
+    """Identifies a zip by (path, size, mtime), so that anything cached about it is re-read when it changes."""
+    stat = os.stat(zip_name)
+    return os.path.abspath(zip_name), stat.st_size, stat.st_mtime_ns
+
+
+def _cached_namelist(zip_name):
+    """The names of the files in a zip, only re-read if the zip changed on disk."""
+    return _read_namelist(*_zip_cache_key(zip_name))
+
+
+@functools.lru_cache(maxsize=32)
+def _read_namelist(zip_name, size, mtime_ns):
+    # size and mtime_ns are only part of the cache key
+    with zipfile.ZipFile(zip_name, "r") as zip:
+        return tuple(zip.namelist())
+
+
+def _cached_library_names(zip_name, prefix=None):
+    """
+    The libraries in a zip from `create_zip` (or from `create_unique_zip`, with its `prefix`),
+    only re-read if the zip changed on disk.
+    """
+    return list(_read_library_names(*_zip_cache_key(zip_name), prefix))
+
+
+@functools.lru_cache(maxsize=32)
+def _read_library_names(zip_name, size, mtime_ns, prefix=None):
+    json_name = "library_names.json" if prefix is None else prefix + "/library_names.json"
+    with zipfile.ZipFile(zip_name, "r") as zip:
+        # Written by create_zip, so usually there is no need to look at every file name
+        try:
+            return tuple(_json_loads(zip.read(json_name)))
+        except KeyError:
+            return tuple(_valid_libraries(zip.namelist(), index=0 if prefix is None else 1))
+
+
 class Codebase:
     _ran_already = False
     """
@@ -232,19 +607,8 @@ class Codebase:
     """
 
     def __init__(self, zip_name: str, verbose: bool = False):
-        with zipfile.ZipFile(zip_name, "r") as zip:
-            all_files = zip.namelist()
-
         self.zip_name = zip_name
-        self.valid_libraries = list(
-            set(
-                [
-                    f.replace(".py", "").split("/")[0]
-                    for f in all_files
-                    if ".py" in f and "__init__" not in f.split("/")[1]
-                ]
-            )
-        )
+        self.valid_libraries = _cached_library_names(zip_name)
 
         if verbose:
             print("Found libraries in codebase: ", self.valid_libraries)
@@ -272,6 +636,55 @@ class Codebase:
         self.close()
 
 
+def _unique_zip_cache_path(zip_name):
+    """Where the `create_unique_zip` output for `zip_name` is cached, or None if caching is disabled."""
+    if os.environ.get("CODESAVE_NO_CACHE"):
+        return None
+    stat = os.stat(zip_name)
+    # Named {path}-{version}.zip, so that older copies of the same path can be found and removed
+    path_key = hashlib.blake2b(os.path.abspath(zip_name).encode("utf-8")).hexdigest()[:16]
+    version_key = hashlib.blake2b(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()[:16]
+    cache_dir = Path(os.environ.get("CODESAVE_CACHE", "~/.cache/codesave")).expanduser()
+    return cache_dir / f"{path_key}-{version_key}.zip"
+
+
+def _make_unique_copy(zip_name, verbose=False, cache=False):
+    """
+    Runs `create_unique_zip` on `zip_name`, reusing a cached copy if possible.
+    Returns the new path, and the libraries in it (None if the cached copy was reused).
+    """
+    cached_name = _unique_zip_cache_path(zip_name) if cache else None
+    if cached_name is None:
+        tmp_name = tempfile.mktemp(suffix=".zip")
+        print("Making unique copy of ", zip_name, " at ", tmp_name)
+        library_names = create_unique_zip(zip_name, tmp_name, verbose=verbose)
+        return tmp_name, library_names
+
+    if cached_name.exists() and cached_name.stat().st_mtime >= os.stat(zip_name).st_mtime:
+        print("Using unique copy of ", zip_name, " cached at ", cached_name)
+        return str(cached_name), None
+
+    cached_name.parent.mkdir(parents=True, exist_ok=True)
+    # Written next to its final location and then renamed, so a cached zip is never partial
+    tmp_name = tempfile.mktemp(suffix=".zip", dir=cached_name.parent)
+    print("Making unique copy of ", zip_name, " at ", cached_name)
+    try:
+        library_names = create_unique_zip(zip_name, tmp_name, verbose=verbose)
+        os.replace(tmp_name, cached_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    # Only the latest copy of each zip is kept, so the cache doesn't grow every time a zip is rewritten
+    path_key = cached_name.name.split("-")[0]
+    for stale in cached_name.parent.glob(f"{path_key}-*.zip"):
+        if stale != cached_name:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+    return str(cached_name), library_names
+
+
 class UniqueCodebase:
     """
     A codebase so that you can load multiple versions of the same codebase,
@@ -300,32 +713,39 @@ class UniqueCodebase:
 
     """
 
-    def __init__(self, zip_name: str, verbose: bool = False, make_unique: bool = True):
+    def __init__(
+        self,
+        zip_name: str,
+        verbose: bool = False,
+        make_unique: bool = True,
+        cache: bool = False,
+    ):
+        """
+        Args:
+            zip_name: A zip made by `create_zip` (or by `create_unique_zip` if make_unique=False)
+            make_unique: If True, runs `create_unique_zip` on the zip first.
+            cache: If True, the output of `create_unique_zip` is kept in $CODESAVE_CACHE
+                (default: ~/.cache/codesave) and reused as long as `zip_name` doesn't change.
+                Opening the same unchanged zip twice then gives the same modules.
+                Only the latest copy of each zip is kept.
+                Setting $CODESAVE_NO_CACHE disables this everywhere.
+        """
+        library_names = None
         if make_unique:
-            tmp_name = tempfile.mktemp(suffix=".zip")
-            print("Making unique copy of ", zip_name, " at ", tmp_name)
-            create_unique_zip(zip_name, tmp_name, verbose=verbose)
-            zip_name = tmp_name
+            zip_name, library_names = _make_unique_copy(zip_name, verbose=verbose, cache=cache)
         else:
             print("Are you sure you already ran `create_unique_zip`?")
 
-        with zipfile.ZipFile(zip_name, "r") as zip:
-            all_files = zip.namelist()
-            self._library_name = all_files[0].split("/")[0]
+        all_files = _cached_namelist(zip_name)
+        self._library_name = all_files[0].split("/")[0]
 
         self.zip_name = zip_name
         sys.path.insert(0, zip_name)
         importlib.invalidate_caches()
 
-        self.valid_libraries = list(
-            set(
-                [
-                    f.replace(".py", "").split("/")[1]
-                    for f in all_files
-                    if ".py" in f and "__init__" not in f.split("/")[1]
-                ]
-            )
-        )
+        if library_names is None:
+            library_names = _cached_library_names(zip_name, prefix=self._library_name)
+        self.valid_libraries = library_names
 
         print("Found libraries in codebase: ", self.valid_libraries)
 
@@ -357,7 +777,7 @@ class UniqueCodebase:
             ):  # Dealing with the fact that import a.b should return a, not b
                 as_ = name.split(".")[0]
                 lib = importlib.import_module(f"{self.library_name}.{as_}")
-        calling_locals = inspect.stack()[1].frame.f_locals
+        calling_locals = sys._getframe(1).f_locals
         calling_locals[as_] = lib
 
     def from_import(self, name, things_to_import, as_=None):
@@ -365,7 +785,7 @@ class UniqueCodebase:
         if isinstance(things_to_import, str):
             things_to_import = [things_to_import]
 
-        calling_locals = inspect.stack()[1].frame.f_locals
+        calling_locals = sys._getframe(1).f_locals
         if as_ is not None:
             assert len(things_to_import) == 1
             as_ = {as_: things_to_import[0]}
@@ -394,24 +814,58 @@ class UniqueCodebase:
         self.close()
 
 
-def _fix_all_imports(
-    original_text,
+def _import_pattern(libraries, old_pattern=lambda library: f"{library}"):
+    """
+    Compiles a bytes regex matching the import statements that `_fix_all_imports` rewrites, i.e.
+    `import lib `, `import lib.`, `from lib.` and `from lib ` at the start of a (possibly indented)
+    line, so that mentions in comments or in the middle of a line are left alone.
+
+    A bare `import lib` (at the end of a line) is left alone: `import prefix.lib` would bind the
+    name `prefix` instead of `lib`, so every later `lib.x` would break.
+
+    The last group of a match is the library, the one before it is everything up to the library.
+    """
+    if not libraries:
+        return re.compile(rb"(?!)")  # never matches
+    # Longest first, so that a library is never shadowed by one of its prefixes
+    alternation = b"|".join(
+        re.escape(old_pattern(library).encode("utf-8"))
+        for library in sorted(libraries, key=len, reverse=True)
+    )
+    return re.compile(
+        rb"^([ \t]*import )(%s)(?=[ .])|^([ \t]*from )(%s)(?=\.|\s|$)" % (alternation, alternation),
+        re.MULTILINE,
+    )
+
+
+def _import_replacements(
     libraries,
     new_pattern,
     old_pattern=lambda library: f"{library}",
 ):
-    all_changes = []
-    for library in libraries:
-        op = old_pattern(library)
-        np = new_pattern(library)
-        all_changes.append((f"import {op} ", f"import {np} "))
-        all_changes.append((f"import {op}.", f"import {np}."))
-        all_changes.append((f"from {op}.", f"from {np}."))
+    """Maps each library's old import name to its new one, as bytes (see `_fix_all_imports`)."""
+    return {
+        old_pattern(library).encode("utf-8"): new_pattern(library).encode("utf-8")
+        for library in libraries
+    }
 
-    new_s = original_text
-    for old_string, new_string in all_changes:
-        new_s = new_s.replace(old_string, new_string)
-    return new_s
+
+def _fix_all_imports(original_text, pattern, replacements):
+    """
+    Rewrites imports in a single pass over `original_text`.
+
+    Works directly on the (utf-8) bytes of a source file, since import statements are ASCII.
+    `pattern` and `replacements` come from `_import_pattern` and `_import_replacements`, and are
+    built once for all the files in a codebase.
+    """
+    # Many files don't mention any of the libraries at all; a substring search is much cheaper than the regex
+    if not any(old in original_text for old in replacements):
+        return original_text
+    return pattern.sub(
+        lambda match: match.group(match.lastindex - 1)
+        + replacements[match.group(match.lastindex)],
+        original_text,
+    )
 
 
 def _get_library_names(all_fnames, index=0):
@@ -422,64 +876,175 @@ def _get_library_names(all_fnames, index=0):
     These are either python files in the top directory, or directories with python files in them.
 
     """
-    return list(
-        set([f.split("/")[index].replace(".py", "") for f in all_fnames if ".py" in f])
+    library_names = {}  # a dict keeps the libraries in the order they are found
+    for f in all_fnames:
+        if f.endswith(".py"):
+            name = f.split("/", index + 1)[index]
+            library_names[name[:-3] if name.endswith(".py") else name] = None
+    return list(library_names)
+
+
+def _glob_regex(glob_patterns):
+    """Compiles a regex that matches a name if any of the glob patterns do (see fnmatch)."""
+    if not glob_patterns:
+        return re.compile(r"(?!)")  # never matches
+    return re.compile(
+        "|".join(
+            "(?:{})".format(fnmatch.translate(os.path.normcase(glob_pattern)))
+            for glob_pattern in glob_patterns
+        )
     )
 
 
+def _glob_matcher(glob_patterns):
+    """
+    Returns a function that tells whether a (normcased) name matches any of the glob patterns.
+    Patterns that are all like "*.py" are checked with a single str.endswith instead of a regex.
+    """
+    glob_patterns = [os.path.normcase(glob_pattern) for glob_pattern in glob_patterns]
+    if all(
+        glob_pattern.startswith("*") and not any(c in glob_pattern[1:] for c in "*?[")
+        for glob_pattern in glob_patterns
+    ):
+        suffixes = tuple(glob_pattern[1:] for glob_pattern in glob_patterns)
+        return lambda name: name.endswith(suffixes)
+    return _glob_regex(glob_patterns).match
+
+
+def _valid_libraries(all_files, index):
+    """
+    Given the file names in a codebase zip, returns the libraries found `index` folders deep:
+    python files (other than `__init__.py` and the `__main__.py` launcher) and folders with python files in them.
+
+    Each name is split at most once, and only up to the level we are interested in.
+    The libraries are returned in the order they first appear in.
+    """
+    libraries = {}
+    for f in all_files:
+        if not f.endswith(".py"):
+            continue
+        parts = f.split("/", index + 1)
+        if len(parts) <= index:
+            continue
+        name = parts[index]
+        if len(parts) == index + 1:  # A python file at this level
+            name = name[:-3]
+            if name in ("__init__", "__main__"):
+                continue
+        libraries[name] = None
+    return list(libraries)
+
+
+def _accepts_dir_entries(fn):
+    """
+    Marks an ignore function as taking an optional third argument `entries`, a dict from
+    name to the `os.DirEntry` that `create_zip` already has for it. Using those instead of
+    the paths avoids stat-ing every file again.
+    """
+    fn.accepts_dir_entries = True
+    return fn
+
+
+def _call_ignore(ignore, path, names, entries=None):
+    """Calls a shutil.copytree-style ignore function, with the DirEntries if it can use them."""
+    if entries is not None and getattr(ignore, "accepts_dir_entries", False):
+        return ignore(path, names, entries)
+    return ignore(path, names)
+
+
+def _dir_entries(path, entries=None):
+    """
+    The DirEntries in `path` by name: the ones create_zip passed along (for its top-level inputs,
+    possibly Paths), or else (e.g. when called by shutil.copytree) a single scan of `path`,
+    which is cheaper than a stat per name.
+    """
+    if entries is None:
+        with os.scandir(path) as it:
+            entries = {entry.name: entry for entry in it}
+    return entries
+
+
+def _parse_size(size):
+    """Parses a size like '100k', '10m', '1g' or '500' into a number of bytes. Numbers are returned as-is."""
+    if isinstance(size, str):
+        try:
+            if size.isdigit():
+                return int(size)
+            size, modifier = int(size[:-1]), size[-1].lower()
+            modifier = {"k": 1000, "m": 1000**2, "g": 1000**3}[modifier]
+            size *= modifier
+        except:
+            raise ValueError(
+                "Could not parse size argument. Expected something like '1k', '10m', '1g'"
+            )
+    return size
+
+
 class shutil_filters:
-    # Factory functions for creating filters for shutil.copytree
+    # Factory functions for creating filters for shutil.copytree.
+    # They also accept the DirEntries that create_zip passes along (see _accepts_dir_entries),
+    # and return the ignored names as a set, which copytree accepts as well.
 
     @staticmethod
     def chain(*fns):
-        def chained_fn(path, names):
+        @_accepts_dir_entries
+        def chained_fn(path, names, entries=None):
+            # Each filter only sees the names that the previous ones kept, so cheap filters
+            # (e.g. patterns) placed first save the later ones from stat-ing excluded files.
+            # The folder is scanned at most once, for all of them.
+            entries = _dir_entries(path, entries)
             excluded = set()
             for fn in fns:
-                excluded.update(fn(path, names))
-            return list(excluded)
+                if not names:
+                    break
+                newly_excluded = _call_ignore(fn, path, names, entries)
+                if newly_excluded:
+                    excluded.update(newly_excluded)
+                    names = [name for name in names if name not in excluded]
+            return excluded
 
         return chained_fn
 
     @staticmethod
     def ignore_larger_than(size):
-        if isinstance(size, str):
-            try:
-                size, modifier = int(size[:-1]), size[-1].lower()
-                modifier = {"k": 1e3, "m": 1e6, "g": 1e9}[modifier]
-                size *= modifier
-            except:
-                raise ValueError(
-                    "Could not parse size argument. Expected something like '1k', '10m', '1g'"
-                )
+        size = _parse_size(size)
 
-        def fn(path, names):
-            excluded_names = []
+        @_accepts_dir_entries
+        def fn(path, names, entries=None):
+            entries = _dir_entries(path, entries)
+            excluded_names = set()
             for name in names:
-                name_path = Path(path) / name
-                if name_path.is_file() and name_path.stat().st_size > size:
-                    excluded_names.append(name)
+                entry = entries.get(name)
+                if entry is not None and entry.is_file() and entry.stat().st_size > size:
+                    excluded_names.add(name)
             return excluded_names
 
         return fn
 
     @staticmethod
     def ignore_patterns(*glob_patterns):
-        return shutil.ignore_patterns(*glob_patterns)
+        # Like shutil.ignore_patterns, but all patterns are matched at once (see _glob_matcher)
+        matches = _glob_matcher(glob_patterns)
+
+        def fn(path, names):
+            return {name for name in names if matches(os.path.normcase(name))}
+
+        return fn
 
     @staticmethod
     def include_only_patterns(*glob_patterns):
-        def fn(path, names):
-            excluded_names = []
+        # Matched against the full path of each file, all patterns at once
+        matches = _glob_matcher(glob_patterns)
+
+        @_accepts_dir_entries
+        def fn(path, names, entries=None):
+            entries = _dir_entries(path, entries)
+            excluded_names = set()
             for name in names:
-                name_path = Path(path) / name
-                if name_path.is_file():
-                    if not any(
-                        [
-                            fnmatch.fnmatch(name_path, glob_pattern)
-                            for glob_pattern in glob_patterns
-                        ]
-                    ):
-                        excluded_names.append(name)
+                entry = entries.get(name)
+                if entry is not None and entry.is_file():
+                    if not matches(os.path.normcase(os.path.join(path, name))):
+                        excluded_names.add(name)
             return excluded_names
 
         return fn
@@ -1,24 +1,69 @@
-from .base import create_zip, shutil_filters, Codebase, UniqueCodebase
-import glob
+from .base import create_zip, shutil_filters, Codebase, UniqueCodebase, _installed_packages, _parse_size
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import os
 from pathlib import Path
 import tempfile
-import pkg_resources
-import shutil
 import zipfile
 
+def _has_py(folder):
+    """Whether there is a python file anywhere inside `folder`. Stops at the first one it finds."""
+    folders = [folder]
+    while folders:
+        try:
+            it = os.scandir(folders.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.name.startswith("."):  # like a glob, skips hidden files and folders
+                    continue
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif entry.name.endswith(".py"):
+                    return True
+    return False
+
+
+def _is_py_file(name):
+    return os.path.normcase(name).endswith(".py")
+
+
+def _top_level_paths(folder):
+    """Yields the paths directly inside `folder`, leaving out hidden ones like glob("*") did."""
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.name.startswith("."):
+                yield entry.path
+
+
 def _get_python_libraries(pythonpath: Path):
-    pythonpath = pythonpath.expanduser().resolve()
+    if not pythonpath.is_absolute():  # otherwise it was already resolved by checkpoint
+        pythonpath = pythonpath.expanduser().resolve()
     assert pythonpath.is_dir()
+    # Periodic checkpoints scan the same folders again and again, so the result is reused until
+    # the folder itself changes. (Changes deeper inside it are not noticed.)
+    return dict(_scan_python_libraries(pythonpath, pythonpath.stat().st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=32)
+def _scan_python_libraries(pythonpath, mtime_ns):
+    # Maps each library to its path, as a string: create_zip takes those as well as Paths
     libs = {}
-    for path in pythonpath.iterdir():
-        if path.suffix == ".py":
-            libs[path.stem] = path
-        elif path.is_dir():
-            if len(glob.glob(str(path / "**/*.py"), recursive=True)) > 0:
-                libs[path.name] = path
+    with os.scandir(pythonpath) as it:
+        for entry in it:
+            if entry.name.endswith(".py"):
+                libs[entry.name[:-3]] = entry.path
+            elif entry.is_dir() and _has_py(entry.path):
+                libs[entry.name] = entry.path
     return libs
 
 
+_get_python_libraries.cache_clear = _scan_python_libraries.cache_clear
+
+
 def checkpoint(
     main_folder,
     output_zipname=None,
@@ -30,6 +75,9 @@ def checkpoint(
     py_only=False,
     ignore_larger_than=None,  # e.g. "1M"
     verbose=True,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=1,
+    num_workers=1,
 ):
     """Saves a zip file containing all the files in main_folder (and potentially some extra libraries).
 
@@ -47,6 +95,9 @@ def checkpoint(
         py_only: If True, only .py files will be saved.
         ignore_larger_than: Files larger than this will be ignored. Useful to avoid saving large files like datasets or checkpoints.
         output_zipname: Name of the zip file to save to. Defaults to "codebase.zip"
+        compression: zipfile compression method for the entries (ZIP_DEFLATED or ZIP_STORED).
+        compresslevel: Compression level, 1 (fast, the default) to 9 (smallest).
+        num_workers: If larger than 1, files are compressed in parallel using this many threads.
 
 
     To avoid some confusion about `extra_libraries` vs. `extra_pythonpath`: if the external library looks like this:
@@ -68,38 +119,51 @@ def checkpoint(
     ), "either main_folder or extra_libraries must be specified"
 
     verbose_print = print if verbose else lambda *args, **kwargs: None
+    # Resolved once here, rather than again by every function they are passed to
+    extra_pythonpath = [Path(path).expanduser().resolve() for path in extra_pythonpath]
+    if main_folder is not None:
+        main_folder = Path(main_folder).expanduser().resolve()
+
     all_libs = {}
-    for path in extra_pythonpath:
-        all_libs.update(_get_python_libraries(Path(path)))
+    if len(extra_pythonpath) > 1:
+        # Scanning is mostly waiting on the file system (e.g. NFS), so the folders are scanned at once
+        with ThreadPoolExecutor(max_workers=min(8, len(extra_pythonpath))) as executor:
+            for libs in executor.map(_get_python_libraries, extra_pythonpath):
+                all_libs.update(libs)
+    else:
+        for path in extra_pythonpath:
+            all_libs.update(_get_python_libraries(path))
     
     if main_folder is not None:
-        all_libs.update(_get_python_libraries(Path(main_folder)))
+        all_libs.update(_get_python_libraries(main_folder))
 
     for path in extra_libraries:
         path = Path(path).expanduser().resolve()
         all_libs[path.stem] = path
 
-    all_files = list(all_libs.values())
-    if main_folder is not None:
-        main_folder = Path(main_folder).expanduser().resolve()
-        main_libs = _get_python_libraries(main_folder)
-        all_libs.update(main_libs)
-        all_files.extend(glob.glob(str(main_folder / "*")))
-
-    all_files.extend(extra_files)
-
+    all_files = itertools.chain(
+        all_libs.values(),
+        _top_level_paths(main_folder) if main_folder is not None else (),
+        extra_files,
+    )
+    if verbose:  # create_zip only needs to iterate over them once
+        all_files = list(all_files)
     verbose_print("All files: ", all_files)
     verbose_print("All libs: ", all_libs.keys())
 
     if len(ignore_patterns) > 0:
         verbose_print("Ignoring patterns: ", ignore_patterns)
         ignore += (shutil_filters.ignore_patterns(*ignore_patterns),)
+    name_filter = None
     if py_only:
         verbose_print("Ignoring all py files")
-        ignore += (shutil_filters.include_only_patterns("*.py"),)
+        # Applied by create_zip while walking, before any of the other filters
+        name_filter = _is_py_file
+    max_file_size = None
     if ignore_larger_than is not None:
         verbose_print("Ignoring files larger than: ", ignore_larger_than)
-        ignore += (shutil_filters.ignore_larger_than(ignore_larger_than),)
+        # Checked by create_zip while walking, rather than by a filter that stats every file again
+        max_file_size = _parse_size(ignore_larger_than)
 
     if len(ignore) > 0:
         ignore = shutil_filters.chain(*ignore)
@@ -112,9 +176,42 @@ def checkpoint(
         library_names=list(all_libs.keys()),
         ignore=ignore,
         verbose=verbose,
+        compression=compression,
+        compresslevel=compresslevel,
+        max_file_size=max_file_size,
+        name_filter=name_filter,
+        num_workers=num_workers,
     )
 
 
+# Uploads started by `checkpoint_to_wandb(async_upload=True)` run here, one at a time.
+_UPLOAD_EXECUTOR = None
+_PENDING_UPLOADS = []
+
+
+def _save_to_wandb(*paths):
+    import wandb
+
+    for path in paths:
+        wandb.save(str(path), policy="now")
+
+
+def _write_packages_txt(path):
+    with open(path, "w") as f:
+        f.write(_installed_packages())
+
+
+def wait_for_uploads():
+    """Blocks until all uploads started by `checkpoint_to_wandb` are done.
+
+    This is registered to run at exit, so it only needs to be called explicitly
+    if you want to make sure the codebase is uploaded before doing something else
+    (e.g. calling `wandb.finish()`).
+    """
+    while _PENDING_UPLOADS:
+        _PENDING_UPLOADS.pop(0).result()
+
+
 def checkpoint_to_wandb(
     main_folder,
     output_directory=None,
@@ -126,6 +223,10 @@ def checkpoint_to_wandb(
     ignore_larger_than="100K",  # Be conservative by default for wandb, since the file needs to be uploaded
     verbose=True,
     codebase_zipname="codebase.zip",
+    async_upload=False,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=9,  # Uploading takes much longer than compressing, so compress as much as possible
+    num_workers=1,
 ):
     """See checkpoint_codebase, but also saves the zip file to wandb.
 
@@ -134,6 +235,10 @@ def checkpoint_to_wandb(
         Defaults to wandb.run.dir
     - codebase_zipname: name of the zip file to save to. Defaults to "codebase.zip"
         Note: this will be the name of the file on wandb too. You will need it to download it in the future.
+    - compresslevel: defaults to 9 (instead of 1 for `checkpoint`), since the zip is uploaded.
+    - async_upload: If True, the files are handed to wandb in a background thread and this returns
+        a Future right away. Call `wait_for_uploads()` before finishing the wandb run, otherwise
+        the upload may run after the run is closed and fail.
     """
     import wandb
 
@@ -141,24 +246,51 @@ def checkpoint_to_wandb(
     output_directory = Path(output_directory).expanduser().resolve()
 
     output_zipname = output_directory / codebase_zipname
-    checkpoint(
-        main_folder=main_folder,
-        output_zipname=output_zipname,
-        extra_pythonpath=extra_pythonpath,
-        extra_libraries=extra_libraries,
-        ignore=ignore,
-        ignore_patterns=ignore_patterns,
-        py_only=py_only,
-        ignore_larger_than=ignore_larger_than,
-        verbose=verbose,
-    )
+    packages_name = output_directory / "packages.txt"
+    # packages.txt doesn't depend on the zip, so it is written while the zip is created
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        packages_written = executor.submit(_write_packages_txt, packages_name)
+        checkpoint(
+            main_folder=main_folder,
+            output_zipname=output_zipname,
+            extra_pythonpath=extra_pythonpath,
+            extra_libraries=extra_libraries,
+            ignore=ignore,
+            ignore_patterns=ignore_patterns,
+            py_only=py_only,
+            ignore_larger_than=ignore_larger_than,
+            verbose=verbose,
+            compression=compression,
+            compresslevel=compresslevel,
+            num_workers=num_workers,
+        )
+        packages_written.result()
+
+    paths = (output_zipname, packages_name)
+    if not async_upload:
+        _save_to_wandb(*paths)
+        return None
 
-    with open(output_directory / "packages.txt", "w") as f:
-        for lib in pkg_resources.working_set:
-            f.write(repr(lib) + "\n")
+    global _UPLOAD_EXECUTOR
+    if _UPLOAD_EXECUTOR is None:
+        _UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+        atexit.register(wait_for_uploads)
+    future = _UPLOAD_EXECUTOR.submit(_save_to_wandb, *paths)
+    _PENDING_UPLOADS.append(future)
+    return future
 
-    wandb.save(str(output_zipname), policy="now")
-    wandb.save(str(output_directory / "packages.txt"), policy="now")
+
+_API = None
+
+
+def _get_api():
+    """A wandb.Api() shared by the functions below, since creating one talks to the server."""
+    global _API
+    if _API is None:
+        import wandb
+
+        _API = wandb.Api()
+    return _API
 
 
 def download_from_wandb(
@@ -173,16 +305,18 @@ def download_from_wandb(
     Returns the output_zipname.
     """
     if api is None:
-        import wandb
-
-        api = wandb.Api()
+        api = _get_api()
     run = api.run(wandb_path)
     file = run.file(wandb_filename)
     output_zipname = output_zipname or tempfile.mktemp(suffix=".zip")
-    with tempfile.TemporaryDirectory() as tmpdirname:
+    target = Path(output_zipname).expanduser().resolve()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Downloaded next to output_zipname, so that it can be moved into place without a copy
+    # (a file named wandb_filename that is already there is left alone)
+    with tempfile.TemporaryDirectory(dir=target.parent) as tmpdirname:
         file.download(tmpdirname)
-        shutil.copy2(Path(tmpdirname) / wandb_filename, output_zipname)
-    return output_zipname
+        os.replace(Path(tmpdirname) / wandb_filename, target)
+    return str(target)
 
 
 def zip_from_wandb_artifact(wandb_path, output_zipname=None, api=None):
@@ -199,9 +333,7 @@ def zip_from_wandb_artifact(wandb_path, output_zipname=None, api=None):
     Returns the output_zipname.
     """
     if api is None:
-        import wandb
-
-        api = wandb.Api()
+        api = _get_api()
     run = api.run(wandb_path)
 
     artifacts = []
@@ -239,8 +371,7 @@ def zip_from_wandb(wandb_path, output_zipname=None, api=None, artifact=None):
     """Convenience function combining download_from_wandb and zip_from_wandb_artifact."""
     
     if artifact is None:
-        import wandb
-        api = api or wandb.Api()
+        api = api or _get_api()
         run = api.run(wandb_path)
         artifact = not any([f.name == "codebase.zip" for f in run.files()])
     if artifact:
@@ -253,4 +384,5 @@ class WandBCodebase(UniqueCodebase):
     def __init__(self, wandb_path, api=None, artifact=None, make_unique=True):
         self.tmp_name = tempfile.mktemp(suffix=".zip")
         zip_from_wandb(wandb_path, output_zipname=self.tmp_name, api=api, artifact=artifact)
-        super().__init__(self.tmp_name, make_unique=make_unique)
+        # The downloaded zip is new every time, so there is nothing to gain from caching it
+        super().__init__(self.tmp_name, make_unique=make_unique, cache=False)
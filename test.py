@@ -7,6 +7,7 @@ from codesave import (
     checkpoint,
     checkpoint_to_wandb,
     download_from_wandb,
+    wait_for_uploads,
 )
 
 main_folder = "~/nfs2/playground/advantage_learning"
@@ -37,6 +38,7 @@ def test_wandb():
         extra_libraries=extra_libraries,
         verbose=True,
     )
+    wait_for_uploads()  # a no-op unless async_upload=True; must come before finishing the run
     wandb_path = wandb.run.path
     wandb.run.finish()
     out = download_from_wandb(wandb_path, output_zipname=tempfile.mktemp(suffix=".zip"))